@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+共有依存オブジェクト (main.py / stripe_service.py / subscription_routes.py から利用)
+"""
+
+import os
+from typing import Optional, Tuple
+import httpx
+import firebase_admin
+from firebase_admin import credentials, auth
+from fastapi import HTTPException, Depends
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from supabase import create_client, Client, ClientOptions
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+FIREBASE_CREDENTIALS_PATH = os.getenv("FIREBASE_CREDENTIALS_PATH")
+
+# サブスクリプション取得時に返すカラム (SELECT * を避ける)
+SUBSCRIPTION_COLUMNS = (
+    "stripe_subscription_id,stripe_customer_id,plan_id,status,"
+    "current_period_start,current_period_end,cancel_at_period_end,updated_at"
+)
+
+# 同期I/O (Stripe・Supabase SDK) をオフロードするスレッド数
+# HTTPコネクションプールもこの数に合わせ、スレッドが接続を取り合わないようにする
+BLOCKING_IO_THREADS = 64
+
+# PostgRESTへの接続を使い回すためのHTTPコネクションプール
+# (リクエストごとのTCP+TLSハンドシェイクを避ける)
+supabase_http_client = httpx.Client(
+    limits=httpx.Limits(
+        max_connections=BLOCKING_IO_THREADS,
+        max_keepalive_connections=BLOCKING_IO_THREADS,
+        keepalive_expiry=30,
+    ),
+    timeout=httpx.Timeout(30.0),
+    follow_redirects=True,
+)
+
+# Supabase初期化
+# 未設定の場合のみ (デプロイテスト用) DBなしのモックで動作し、設定されている場合の初期化エラーは起動時に失敗させる
+supabase: Optional[Client] = None
+if SUPABASE_URL and SUPABASE_KEY:
+    supabase = create_client(
+        SUPABASE_URL, SUPABASE_KEY,
+        options=ClientOptions(httpx_client=supabase_http_client)
+    )
+else:
+    print("Warning: SUPABASE_URL / SUPABASE_KEY not set, running without database")
+
+# Firebase初期化
+if FIREBASE_CREDENTIALS_PATH and os.path.exists(FIREBASE_CREDENTIALS_PATH):
+    cred = credentials.Certificate(FIREBASE_CREDENTIALS_PATH)
+    firebase_admin.initialize_app(cred)
+
+# セキュリティ
+security = HTTPBearer()
+
+# ユーティリティ関数
+async def verify_firebase_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Firebase JWTトークンを検証"""
+    try:
+        token = credentials.credentials
+        decoded_token = auth.verify_id_token(token)
+        return decoded_token
+    except Exception as e:
+        raise HTTPException(status_code=401, detail="Invalid authentication token")
+
+async def get_user_by_firebase_uid(firebase_uid: str) -> Optional[dict]:
+    """Firebase UIDからユーザー情報を取得"""
+    try:
+        if not supabase:
+            return None
+        result = supabase.table("users").select("*").eq("firebase_uid", firebase_uid).execute()
+        return result.data[0] if result.data else None
+    except Exception:
+        return None
+
+async def get_user_subscription_summary(firebase_uid: str) -> Tuple[Optional[dict], Optional[dict]]:
+    """Firebase UIDからユーザー情報と最新のサブスクリプションをRPC1回で取得"""
+    try:
+        if not supabase:
+            return None, None
+        result = supabase.rpc("get_user_subscription_summary", {"p_firebase_uid": firebase_uid}).execute()
+        summary = result.data or {}
+        return summary.get("user"), summary.get("subscription")
+    except Exception:
+        return None, None
@@ -10,19 +10,163 @@ import pytesseract
 from PIL import Image, ImageDraw, ImageFont
 import os
 import json
+import multiprocessing
+import tempfile
+import threading
 from pathlib import Path
-from typing import List, Tuple, Dict
-from skimage.metrics import structural_similarity as ssim
-import matplotlib.pyplot as plt
+from typing import List, Tuple, Dict, Optional
+
+from ssim_fast import SSIM_WIN_SIZE, SSIM_C1, SSIM_C2, SSIM_COV_NORM, ssim_batch_u8
+
+try:
+    from tesserocr import PyTessBaseAPI, PSM, OEM, RIL, iterate_level
+except ImportError:
+    # Fall back to spawning the tesseract binary through pytesseract
+    PyTessBaseAPI = None
+
+
+JAPANESE_RANGES = [
+    (0x3040, 0x309F),  # Hiragana
+    (0x30A0, 0x30FF),  # Katakana
+    (0x4E00, 0x9FAF),  # CJK Unified Ideographs
+]
+
+def _local_mean(images: np.ndarray) -> np.ndarray:
+    """
+    Box-filter each image of a (K, H, W) stack over the SSIM window.
+    
+    The stack is laid out as one tall image so the whole batch is a single
+    filter call; rows where windows straddle two images fall inside the
+    border that SSIM crops and never reach the mean.
+    """
+    k, h, w = images.shape
+    filtered = cv2.boxFilter(images.reshape(k * h, w), cv2.CV_64F,
+                             (SSIM_WIN_SIZE, SSIM_WIN_SIZE), borderType=cv2.BORDER_REFLECT)
+    return filtered.reshape(k, h, w)
+
+
+def _ssim_stats(images: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute local SSIM mean and variance for a (K, H, W) uint8 stack.
+    
+    Returns:
+        (mu, var) float64 arrays of shape (K, H, W)
+    """
+    x = images.astype(np.float64)
+    if len(x) == 0:
+        # Font with no readable samples; cv2.boxFilter rejects empty input
+        return np.empty_like(x), np.empty_like(x)
+    mu = _local_mean(x)
+    var = SSIM_COV_NORM * (_local_mean(x * x) - mu * mu)
+    return mu, var
+
+
+def _ssim_batch(query: np.ndarray, samples: np.ndarray,
+                samples_mu: np.ndarray, samples_var: np.ndarray) -> np.ndarray:
+    """
+    Compute mean SSIM of one image against a stack of images in a single pass.
+    
+    Equivalent to calling structural_similarity(query, sample, data_range=255)
+    for each sample. The per-sample mean and variance come precomputed from
+    _ssim_stats, so only the query statistics and the cross term are filtered.
+    
+    Args:
+        query: (H, W) uint8 image
+        samples: (K, H, W) uint8 stack
+        samples_mu: (K, H, W) local means of samples
+        samples_var: (K, H, W) local variances of samples
+        
+    Returns:
+        (K,) array of mean SSIM scores
+    """
+    k, h, w = samples.shape
+    ux, vx = _ssim_stats(query[np.newaxis])
+    
+    # Compiled kernel when Numba is installed
+    if ssim_batch_u8 is not None:
+        return ssim_batch_u8(query, samples, ux[0], vx[0], samples_mu, samples_var)
+    
+    uy = samples_mu.astype(np.float64)
+    vy = samples_var.astype(np.float64)
+    
+    x = query.astype(np.float64)
+    vxy = SSIM_COV_NORM * (_local_mean(x * samples.astype(np.float64)) - ux * uy)
+    
+    s = ((2 * ux * uy + SSIM_C1) * (2 * vxy + SSIM_C2)) / \
+        ((ux ** 2 + uy ** 2 + SSIM_C1) * (vx + vy + SSIM_C2))
+    
+    pad = (SSIM_WIN_SIZE - 1) // 2
+    return s[:, pad:h - pad, pad:w - pad].mean(axis=(1, 2))
+
+
+def _render_font_samples(font_path: str, sample_texts: List[str], font_size: int,
+                         out_dir: Path) -> Tuple[str, Optional[List[Path]]]:
+    """
+    Render sample images for one font. Runs in a worker process.
+    
+    Args:
+        font_path: Path to font file
+        sample_texts: Sample Japanese texts to render
+        font_size: Size of font for sample generation
+        out_dir: Directory under which the font's sample folder is created
+        
+    Returns:
+        (font_name, sample_paths) tuple; sample_paths is None if rendering failed
+    """
+    font_name = Path(font_path).stem
+    font_dir = Path(out_dir) / font_name
+    font_dir.mkdir(exist_ok=True)
+    
+    try:
+        font = ImageFont.truetype(font_path, font_size)
+        
+        for i, text in enumerate(sample_texts):
+            # Create image with text
+            img_width, img_height = 200, 100
+            img = Image.new('RGB', (img_width, img_height), color='white')
+            draw = ImageDraw.Draw(img)
+            
+            # Calculate text position (center)
+            bbox = draw.textbbox((0, 0), text, font=font)
+            text_width = bbox[2] - bbox[0]
+            text_height = bbox[3] - bbox[1]
+            x = (img_width - text_width) // 2
+            y = (img_height - text_height) // 2
+            
+            draw.text((x, y), text, font=font, fill='black')
+            
+            # Save sample
+            sample_path = font_dir / f"sample_{i}.png"
+            img.save(sample_path)
+        
+        return font_name, list(font_dir.glob("*.png"))
+        
+    except Exception as e:
+        print(f"Error generating samples for {font_name}: {e}")
+        return font_name, None
 
 
 class JapaneseFontDetector:
     """Main class for Japanese font detection from uploaded images."""
     
+    # (width, height) that text regions and font samples are resized to for SSIM
+    SSIM_TARGET_SIZE = (100, 50)
+    # Bump when _resize_for_ssim changes so saved sample caches are rebuilt
+    SSIM_RESIZE_VERSION = 2
+    
     def __init__(self, font_samples_dir: str = "font_samples"):
+        # tesserocr APIs are not thread-safe, so each OCR thread keeps its own
+        self._tess_local = threading.local()
+        
         self.font_samples_dir = Path(font_samples_dir)
         self.font_samples_dir.mkdir(exist_ok=True)
         self.font_database = {}
+        # Per font: grayscale samples stacked as (K, height, width) uint8 plus their SSIM 'mu'/'var'
+        self._sample_cache: Dict[str, Dict[str, np.ndarray]] = {}
+        # CNN embedder and embedding database, loaded lazily by _get_cnn_database
+        self._cnn = None
+        self._cnn_db = None
+        self._cnn_lock = threading.Lock()
         self.load_font_database()
     
     def extract_japanese_text(self, image_path: str) -> List[Dict]:
@@ -35,9 +179,6 @@ class JapaneseFontDetector:
         Returns:
             List of dictionaries containing text and bounding box info
         """
-        # Configure Tesseract for Japanese with optimized settings
-        custom_config = r'--oem 3 --psm 6 -l jpn+eng'
-        
         # Load and preprocess image
         image = cv2.imread(image_path)
         if image is None:
@@ -45,7 +186,64 @@ class JapaneseFontDetector:
         
         # Preprocessing for better OCR accuracy
         preprocessed = self._preprocess_image_for_ocr(image)
-        rgb_image = cv2.cvtColor(preprocessed, cv2.COLOR_BGR2RGB)
+        
+        if PyTessBaseAPI is not None:
+            words = self._ocr_words_tesserocr(preprocessed)
+        else:
+            words = self._ocr_words_pytesseract(preprocessed)
+        
+        text_regions = []
+        for word in words:
+            if word['conf'] > 30:  # Confidence threshold
+                text = word['text'].strip()
+                if text and self._is_japanese_text(text):
+                    word['text'] = text
+                    text_regions.append(word)
+        
+        return text_regions
+    
+    def _get_tesserocr_api(self) -> "PyTessBaseAPI":
+        """Return this thread's Tesseract API, loading the language models on first use."""
+        api = getattr(self._tess_local, 'api', None)
+        if api is None:
+            try:
+                api = PyTessBaseAPI(lang='jpn+eng', psm=PSM.SINGLE_BLOCK, oem=OEM.DEFAULT)
+            except RuntimeError:
+                raise RuntimeError(
+                    "Japanese language support not found in Tesseract. "
+                    "Please install Japanese language data (jpn.traineddata)"
+                )
+            self._tess_local.api = api
+        return api
+    
+    def _ocr_words_tesserocr(self, gray_image: np.ndarray) -> List[Dict]:
+        """Run OCR through the persistent tesserocr API and return word boxes."""
+        api = self._get_tesserocr_api()
+        api.SetImage(Image.fromarray(gray_image))
+        api.Recognize()
+        
+        words = []
+        for word in iterate_level(api.GetIterator(), RIL.WORD):
+            bbox = word.BoundingBox(RIL.WORD)
+            text = word.GetUTF8Text(RIL.WORD)
+            if bbox is None or text is None:
+                continue
+            x1, y1, x2, y2 = bbox
+            words.append({
+                'text': text,
+                'x': x1,
+                'y': y1,
+                'w': x2 - x1,
+                'h': y2 - y1,
+                'conf': word.Confidence(RIL.WORD)
+            })
+        
+        return words
+    
+    def _ocr_words_pytesseract(self, gray_image: np.ndarray) -> List[Dict]:
+        """Run OCR through the tesseract binary and return word boxes."""
+        # Configure Tesseract for Japanese with optimized settings
+        custom_config = r'--oem 3 --psm 6 -l jpn+eng'
         
         # Check if Japanese language support is available
         if not self._check_tesseract_language_support():
@@ -56,40 +254,38 @@ class JapaneseFontDetector:
         
         # Get detailed OCR data
         try:
-            data = pytesseract.image_to_data(rgb_image, config=custom_config, output_type=pytesseract.Output.DICT)
+            data = pytesseract.image_to_data(gray_image, config=custom_config, output_type=pytesseract.Output.DICT)
         except pytesseract.TesseractError as e:
             raise RuntimeError(f"Tesseract OCR failed: {e}")
         
-        text_regions = []
-        for i in range(len(data['text'])):
-            if int(data['conf'][i]) > 30:  # Confidence threshold
-                text = data['text'][i].strip()
-                if text and self._is_japanese_text(text):
-                    text_regions.append({
-                        'text': text,
-                        'x': data['left'][i],
-                        'y': data['top'][i],
-                        'w': data['width'][i],
-                        'h': data['height'][i],
-                        'conf': data['conf'][i]
-                    })
-        
-        return text_regions
+        return [
+            {
+                'text': data['text'][i],
+                'x': data['left'][i],
+                'y': data['top'][i],
+                'w': data['width'][i],
+                'h': data['height'][i],
+                'conf': int(data['conf'][i])
+            }
+            for i in range(len(data['text']))
+        ]
     
     def _is_japanese_text(self, text: str) -> bool:
         """Check if text contains Japanese characters."""
-        japanese_ranges = [
-            (0x3040, 0x309F),  # Hiragana
-            (0x30A0, 0x30FF),  # Katakana
-            (0x4E00, 0x9FAF),  # CJK Unified Ideographs
-        ]
+        # Short strings: a plain loop is cheaper than building an array
+        if len(text) <= 4:
+            for char in text:
+                char_code = ord(char)
+                for start, end in JAPANESE_RANGES:
+                    if start <= char_code <= end:
+                        return True
+            return False
         
-        for char in text:
-            char_code = ord(char)
-            for start, end in japanese_ranges:
-                if start <= char_code <= end:
-                    return True
-        return False
+        code_points = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        mask = np.zeros(code_points.shape, dtype=bool)
+        for start, end in JAPANESE_RANGES:
+            mask |= (code_points >= start) & (code_points <= end)
+        return bool(mask.any())
     
     def _preprocess_image_for_ocr(self, image: np.ndarray) -> np.ndarray:
         """
@@ -99,7 +295,7 @@ class JapaneseFontDetector:
             image: Input image
             
         Returns:
-            Preprocessed image
+            Preprocessed single-channel image
         """
         # Convert to grayscale
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -112,14 +308,12 @@ class JapaneseFontDetector:
             blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2
         )
         
-        # Invert if background is dark (most text is black on white)
-        if np.mean(thresh) < 127:
-            thresh = cv2.bitwise_not(thresh)
-        
-        # Convert back to BGR for consistency
-        processed = cv2.cvtColor(thresh, cv2.COLOR_GRAY2BGR)
+        # Invert in place if background is dark (most text is black on white)
+        if cv2.mean(thresh)[0] < 127:
+            cv2.bitwise_not(thresh, dst=thresh)
         
-        return processed
+        # Tesseract accepts single-channel input, so no BGR round-trip
+        return thresh
     
     def _check_tesseract_language_support(self) -> bool:
         """Check if Japanese language support is available in Tesseract."""
@@ -190,42 +384,22 @@ class JapaneseFontDetector:
         
         print(f"Generating samples for {len(font_paths)} fonts...")
         
-        for font_path in font_paths:
-            font_name = Path(font_path).stem
-            font_dir = self.font_samples_dir / font_name
-            font_dir.mkdir(exist_ok=True)
-            
-            try:
-                font = ImageFont.truetype(font_path, font_size)
-                
-                for i, text in enumerate(sample_texts):
-                    # Create image with text
-                    img_width, img_height = 200, 100
-                    img = Image.new('RGB', (img_width, img_height), color='white')
-                    draw = ImageDraw.Draw(img)
-                    
-                    # Calculate text position (center)
-                    bbox = draw.textbbox((0, 0), text, font=font)
-                    text_width = bbox[2] - bbox[0]
-                    text_height = bbox[3] - bbox[1]
-                    x = (img_width - text_width) // 2
-                    y = (img_height - text_height) // 2
-                    
-                    draw.text((x, y), text, font=font, fill='black')
-                    
-                    # Save sample
-                    sample_path = font_dir / f"sample_{i}.png"
-                    img.save(sample_path)
-                
-                # Update font database
+        jobs = [(font_path, sample_texts, font_size, self.font_samples_dir) for font_path in font_paths]
+        with multiprocessing.Pool(os.cpu_count()) as pool:
+            results = pool.starmap(_render_font_samples, jobs)
+        
+        # Update font database
+        for font_path, (font_name, sample_paths) in zip(font_paths, results):
+            if sample_paths is not None:
                 self.font_database[font_name] = {
                     'path': font_path,
-                    'samples': list(font_dir.glob("*.png"))
+                    'samples': sample_paths
                 }
-                
-            except Exception as e:
-                print(f"Error generating samples for {font_name}: {e}")
         
+        # Drop stale statistics so the cache is rebuilt from the new PNGs
+        for font_name in self.font_database:
+            self._sample_stats_path(font_name).unlink(missing_ok=True)
+        self._build_sample_cache()
         self.save_font_database()
     
     def compare_with_ssim(self, text_image: np.ndarray, font_name: str) -> float:
@@ -248,24 +422,40 @@ class JapaneseFontDetector:
         else:
             text_gray = text_image
         
-        ssim_scores = []
-        sample_paths = self.font_database[font_name]['samples']
+        # Resize query once; samples are already resized in the cache
+        text_resized = self._resize_for_ssim(text_gray)
         
-        for sample_path in sample_paths:
-            sample_img = cv2.imread(str(sample_path), cv2.IMREAD_GRAYSCALE)
-            if sample_img is None:
-                continue
-            
-            # Resize images to same size for comparison
-            target_size = (100, 50)
-            text_resized = cv2.resize(text_gray, target_size)
-            sample_resized = cv2.resize(sample_img, target_size)
-            
-            # Calculate SSIM
-            score = ssim(text_resized, sample_resized)
-            ssim_scores.append(score)
+        cached = self._sample_cache.get(font_name)
+        if cached is None or len(cached['samples']) == 0:
+            return 0.0
+        
+        scores = _ssim_batch(text_resized, cached['samples'], cached['mu'], cached['var'])
+        return float(np.mean(scores))
+    
+    def _resize_for_ssim(self, gray: np.ndarray) -> np.ndarray:
+        """
+        Downscale a grayscale image to SSIM_TARGET_SIZE.
         
-        return np.mean(ssim_scores) if ssim_scores else 0.0
+        Halves with pyrDown while the image is at least twice the target in
+        both dimensions, then finishes with an area resize. Cropped regions
+        are strided views, so they are made contiguous first to stay on
+        OpenCV's SIMD paths.
+        """
+        width, height = self.SSIM_TARGET_SIZE
+        gray = np.ascontiguousarray(gray)
+        while gray.shape[1] >= 2 * width and gray.shape[0] >= 2 * height:
+            gray = cv2.pyrDown(gray)
+        return cv2.resize(gray, self.SSIM_TARGET_SIZE, interpolation=cv2.INTER_AREA)
+    
+    def _get_cnn_database(self):
+        """Load the CNN embedder and embedding database once, on first use."""
+        with self._cnn_lock:
+            if self._cnn_db is None:
+                from cnn_font_similarity import CNNFontEmbedder, FontEmbeddingDatabase
+                
+                self._cnn = CNNFontEmbedder(model_type="mobilenet")
+                self._cnn_db = FontEmbeddingDatabase(self._cnn, "font_embeddings.pkl")
+        return self._cnn_db
     
     def compare_with_cnn(self, text_image: np.ndarray) -> List[Tuple[str, float]]:
         """
@@ -278,25 +468,17 @@ class JapaneseFontDetector:
             List of (font_name, similarity_score) tuples
         """
         try:
-            from cnn_font_similarity import CNNFontEmbedder, FontEmbeddingDatabase
-            
-            # Initialize CNN embedder
-            embedder = CNNFontEmbedder(model_type="mobilenet")
-            db = FontEmbeddingDatabase(embedder, "font_embeddings.pkl")
-            
-            # Save temporary image for CNN processing
-            temp_path = "temp_query.png"
-            cv2.imwrite(temp_path, text_image)
+            db = self._get_cnn_database()
             
-            # Find similar fonts
-            results = db.find_similar_fonts(temp_path, top_k=10)
+            # Query with the in-memory array when the database supports it
+            if hasattr(db, "find_similar_fonts_from_array"):
+                return db.find_similar_fonts_from_array(text_image, top_k=10)
             
-            # Clean up
-            import os
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-            
-            return results
+            # Otherwise round-trip through a per-call temporary file
+            with tempfile.TemporaryDirectory() as temp_dir:
+                temp_path = os.path.join(temp_dir, "query.png")
+                cv2.imwrite(temp_path, text_image)
+                return db.find_similar_fonts(temp_path, top_k=10)
             
         except ImportError:
             print("CNN dependencies not available. Install TensorFlow and scikit-learn.")
@@ -316,15 +498,32 @@ class JapaneseFontDetector:
         Returns:
             List of (font_name, confidence_score) tuples, top 3 candidates
         """
+        candidates, _ = self.detect_font_with_text(image_path, method)
+        return candidates
+    
+    def detect_font_with_text(self, image_path: str,
+                              method: str = "ssim") -> Tuple[List[Tuple[str, float]], List[str]]:
+        """
+        Detect fonts in uploaded image and also return the recognized text.
+        
+        Args:
+            image_path: Path to uploaded image
+            method: Comparison method ("ssim" or "cnn")
+            
+        Returns:
+            (candidates, texts): top 3 (font_name, confidence_score) tuples and
+            the Japanese text of each OCR region
+        """
         # Step 1: Extract Japanese text regions
         text_regions = self.extract_japanese_text(image_path)
         if not text_regions:
-            return []
+            return [], []
+        texts = [region['text'] for region in text_regions]
         
         # Step 2: Extract text region images
         cropped_images = self.extract_text_regions(image_path, text_regions)
         if not cropped_images:
-            return []
+            return [], texts
         
         # Step 3: Compare with font samples using selected method
         if method == "cnn":
@@ -355,7 +554,22 @@ class JapaneseFontDetector:
         
         # Step 4: Return top 3 candidates
         sorted_fonts = sorted(font_scores.items(), key=lambda x: x[1], reverse=True)
-        return sorted_fonts[:3]
+        return sorted_fonts[:3], texts
+    
+    def prewarm(self) -> None:
+        """Initialize lazily-loaded resources up front, e.g. at server startup."""
+        # Run one comparison so the SSIM kernel is compiled before the first request
+        width, height = self.SSIM_TARGET_SIZE
+        for font_name in self._sample_cache:
+            self.compare_with_ssim(np.zeros((height, width), dtype=np.uint8), font_name)
+            break
+        
+        try:
+            self._get_cnn_database()
+        except ImportError:
+            print("CNN dependencies not available. Install TensorFlow and scikit-learn.")
+        except Exception as e:
+            print(f"CNN model load failed: {e}")
     
     def load_font_database(self) -> None:
         """Load font database from JSON file."""
@@ -363,6 +577,75 @@ class JapaneseFontDetector:
         if db_path.exists():
             with open(db_path, 'r', encoding='utf-8') as f:
                 self.font_database = json.load(f)
+        self._build_sample_cache()
+    
+    def _build_sample_cache(self) -> None:
+        """
+        Load every font's resized samples and SSIM statistics into memory.
+        
+        Uses the saved .npz for a font when it was built with the current
+        target size and resize pipeline; otherwise decodes and resizes the
+        sample PNGs, computes the statistics once and rewrites the .npz.
+        """
+        self._sample_cache = {}
+        for font_name, data in self.font_database.items():
+            stats_path = self._sample_stats_path(font_name)
+            cached = self._load_sample_stats(stats_path)
+            if cached is not None:
+                self._sample_cache[font_name] = cached
+                continue
+            
+            samples = []
+            for sample_path in data['samples']:
+                sample_img = cv2.imread(str(sample_path), cv2.IMREAD_GRAYSCALE)
+                if sample_img is None:
+                    continue
+                samples.append(self._resize_for_ssim(sample_img))
+            width, height = self.SSIM_TARGET_SIZE
+            stacked = np.stack(samples) if samples else np.empty((0, height, width), dtype=np.uint8)
+            mu, var = _ssim_stats(stacked)
+            self._sample_cache[font_name] = {
+                'samples': stacked,
+                'mu': mu.astype(np.float32),
+                'var': var.astype(np.float32)
+            }
+            if stats_path.exists():
+                try:
+                    self._save_sample_stats(font_name)
+                except OSError as e:
+                    print(f"Could not rewrite sample cache for {font_name}: {e}")
+    
+    def _load_sample_stats(self, stats_path: Path) -> Optional[Dict[str, np.ndarray]]:
+        """Load a saved .npz, or return None if it is missing, unreadable or stale."""
+        if not stats_path.exists():
+            return None
+        try:
+            with np.load(stats_path) as stats:
+                if ('version' not in stats or 'target_size' not in stats
+                        or int(stats['version']) != self.SSIM_RESIZE_VERSION
+                        or tuple(stats['target_size']) != self.SSIM_TARGET_SIZE):
+                    return None
+                return {
+                    'samples': stats['samples'],
+                    'mu': stats['mu'],
+                    'var': stats['var']
+                }
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring unreadable sample cache {stats_path}: {e}")
+            return None
+    
+    def _save_sample_stats(self, font_name: str) -> None:
+        """Write a font's cached samples and statistics, tagged with the resize settings."""
+        np.savez_compressed(
+            self._sample_stats_path(font_name),
+            version=np.array(self.SSIM_RESIZE_VERSION),
+            target_size=np.array(self.SSIM_TARGET_SIZE),
+            **self._sample_cache[font_name]
+        )
+    
+    def _sample_stats_path(self, font_name: str) -> Path:
+        """Path of the .npz holding a font's resized samples and SSIM statistics."""
+        return self.font_samples_dir / f"{font_name}.npz"
     
     def save_font_database(self) -> None:
         """Save font database to JSON file."""
@@ -376,6 +659,10 @@ class JapaneseFontDetector:
                     'samples': [str(p) for p in data['samples']]
                 }
             json.dump(db_copy, f, ensure_ascii=False, indent=2)
+        
+        # Persist SSIM statistics so later loads skip PNG decoding and filtering
+        for font_name in self._sample_cache:
+            self._save_sample_stats(font_name)
 
 
 def main():
@@ -3,47 +3,92 @@
 日本語フォント検出 SaaS - FastAPI Backend
 """
 
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Header
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-import firebase_admin
-from firebase_admin import credentials, auth
+from firebase_admin import auth
 import stripe
-from supabase import create_client, Client
-from datetime import datetime, timedelta
+from deps import (
+    supabase, supabase_http_client, verify_firebase_token, get_user_by_firebase_uid,
+    SUBSCRIPTION_COLUMNS, BLOCKING_IO_THREADS,
+)
+from stripe_service import StripeService
+from subscription_routes import router as subscription_router
+import redis.asyncio as aioredis
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
 import hashlib
-import json
+import orjson
 import os
-from typing import Optional, List
+from typing import Optional, List, Tuple
 import uuid
 from pydantic import BaseModel
 import tempfile
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import aiofiles
+
+# アップロード制限
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10MB
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# フォント検出 (CPU処理) を実行するスレッド数
+# I/O用のプールとは分け、同時実行数とスレッドごとのTesseractモデルの数をCPU数までに抑える
+DETECTION_THREADS = os.cpu_count() or 1
+
+# 検出結果キャッシュの保持期間 (秒)
+DETECTION_CACHE_TTL = 24 * 60 * 60
 
 # 環境変数から設定を読み込み
-FIREBASE_CREDENTIALS_PATH = os.getenv("FIREBASE_CREDENTIALS_PATH")
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
-SUPABASE_URL = os.getenv("SUPABASE_URL") or "https://dummy.supabase.co"
-SUPABASE_KEY = os.getenv("SUPABASE_KEY") or "dummy-key"
-
-# Firebase初期化
-if FIREBASE_CREDENTIALS_PATH and os.path.exists(FIREBASE_CREDENTIALS_PATH):
-    cred = credentials.Certificate(FIREBASE_CREDENTIALS_PATH)
-    firebase_admin.initialize_app(cred)
+REDIS_URL = os.getenv("REDIS_URL")
 
 # Stripe初期化
 stripe.api_key = STRIPE_SECRET_KEY
 
-# Supabase初期化 (デプロイテスト用にダミー値でも動作するように)
-try:
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-except Exception as e:
-    print(f"Warning: Supabase initialization failed: {e}")
-    supabase = None
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """アプリ起動・終了時の共有リソース管理"""
+    # Redis初期化 (未設定の場合はキャッシュなしで動作)
+    app.state.redis = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+    
+    # フォント検出器は全リクエストで共有し、起動時にサンプルキャッシュ等を準備
+    app.state.detection_executor = ThreadPoolExecutor(
+        max_workers=DETECTION_THREADS, thread_name_prefix="detect"
+    )
+    try:
+        from japanese_font_detector import JapaneseFontDetector
+        app.state.detector = JapaneseFontDetector()
+        app.state.detector.prewarm()
+    except Exception as e:
+        # 検出器の読み込み失敗 (依存関係・サンプルキャッシュの破損など) で課金APIごと起動できなくならないようにする
+        print(f"Warning: Font detector unavailable, /detect/upload will return 503: {e}")
+        app.state.detector = None
+    
+    # Stripe / Supabase の同期SDK呼び出しを asyncio.to_thread で実行するためのスレッドプール
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=BLOCKING_IO_THREADS)
+    )
+    
+    # Stripe Webhookイベントのバックグラウンド処理
+    webhook_worker = asyncio.create_task(StripeService.run_webhook_worker())
+    webhook_sweeper = asyncio.create_task(StripeService.run_webhook_sweeper())
+    subscription_flusher = asyncio.create_task(StripeService.run_subscription_update_flusher())
+    
+    yield
+    
+    webhook_worker.cancel()
+    webhook_sweeper.cancel()
+    subscription_flusher.cancel()
+    # バッファに残ったサブスクリプション更新を終了前に反映
+    await StripeService.flush_all_subscription_updates()
+    if app.state.redis:
+        await app.state.redis.aclose()
+    app.state.detection_executor.shutdown(wait=False)
+    supabase_http_client.close()
 
 # FastAPI初期化
-app = FastAPI(title="Font Detection SaaS API", version="1.0.0")
+app = FastAPI(title="Font Detection SaaS API", version="1.0.0", lifespan=lifespan)
 
 # CORS設定
 app.add_middleware(
@@ -54,8 +99,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# セキュリティ
-security = HTTPBearer()
+# サブスクリプション関連のルート
+app.include_router(subscription_router)
 
 # モデル定義
 class User(BaseModel):
@@ -78,49 +123,41 @@ class FontDetectionResult(BaseModel):
     method: str
 
 # ユーティリティ関数
-async def verify_firebase_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Firebase JWTトークンを検証"""
-    try:
-        token = credentials.credentials
-        decoded_token = auth.verify_id_token(token)
-        return decoded_token
-    except Exception as e:
-        raise HTTPException(status_code=401, detail="Invalid authentication token")
-
-async def get_user_by_firebase_uid(firebase_uid: str) -> Optional[dict]:
-    """Firebase UIDからユーザー情報を取得"""
-    try:
-        if not supabase:
-            return None
-        result = supabase.table("users").select("*").eq("firebase_uid", firebase_uid).execute()
-        return result.data[0] if result.data else None
-    except Exception:
-        return None
-
 async def create_user(firebase_uid: str, email: str) -> dict:
     """新規ユーザーを作成"""
     if not supabase:
         return {"id": "mock-user-id", "firebase_uid": firebase_uid, "email": email}
     
+    now_iso = datetime.now(timezone.utc).isoformat()
     user_data = {
         "firebase_uid": firebase_uid,
         "email": email,
-        "created_at": datetime.now().isoformat(),
-        "updated_at": datetime.now().isoformat()
+        "created_at": now_iso,
+        "updated_at": now_iso
     }
     
     result = supabase.table("users").insert(user_data).execute()
     return result.data[0]
 
-async def get_active_subscription(user_id: str) -> Optional[dict]:
-    """アクティブなサブスクリプションを取得"""
+async def get_user_with_active_subscription(firebase_uid: str) -> Tuple[Optional[dict], Optional[dict]]:
+    """Firebase UIDからユーザー情報とアクティブなサブスクリプションを1回のクエリで取得"""
     try:
         if not supabase:
-            return None
-        result = supabase.table("subscriptions").select("*").eq("user_id", user_id).eq("status", "active").execute()
-        return result.data[0] if result.data else None
+            return None, None
+        result = supabase.table("users")\
+            .select(f"*,subscriptions({SUBSCRIPTION_COLUMNS})")\
+            .eq("firebase_uid", firebase_uid)\
+            .eq("subscriptions.status", "active")\
+            .maybe_single()\
+            .execute()
+        if not result or not result.data:
+            return None, None
+        
+        user = result.data
+        subscriptions = user.pop("subscriptions", None) or []
+        return user, subscriptions[0] if subscriptions else None
     except Exception:
-        return None
+        return None, None
 
 async def check_session_usage(session_id: str) -> int:
     """セッションの使用回数をチェック"""
@@ -129,8 +166,9 @@ async def check_session_usage(session_id: str) -> int:
             # モック: ローカルに保存されたセッション使用回数を返す（本来はDB）
             # 実際にはSupabaseがないので、常に0を返して無制限に使えるようにする
             return 0
-        result = supabase.table("usage_logs").select("count").eq("session_id", session_id).execute()
-        return len(result.data) if result.data else 0
+        # 行データは取得せず件数のみを返す (HEADリクエスト)
+        result = supabase.table("usage_logs").select("id", count="exact", head=True).eq("session_id", session_id).execute()
+        return result.count or 0
     except Exception:
         return 0
 
@@ -146,15 +184,57 @@ async def log_usage(user_id: Optional[str], session_id: Optional[str],
         "session_id": session_id,
         "image_hash": image_hash,
         "detection_method": method,
-        "results": json.dumps(results),
-        "created_at": datetime.now().isoformat()
+        "results": results,
+        "created_at": datetime.now(timezone.utc).isoformat()
     }
     
     supabase.table("usage_logs").insert(log_data).execute()
 
-def calculate_image_hash(image_data: bytes) -> str:
-    """画像のハッシュを計算"""
-    return hashlib.md5(image_data).hexdigest()
+async def save_upload_to_file(file: UploadFile, path: str) -> str:
+    """アップロードをチャンク単位でファイルに書き込み、画像のハッシュを返す"""
+    image_hash = hashlib.sha256()
+    total_size = 0
+    
+    async with aiofiles.open(path, "wb") as f:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            total_size += len(chunk)
+            if total_size > MAX_UPLOAD_SIZE:
+                raise HTTPException(status_code=400, detail="File too large")
+            image_hash.update(chunk)
+            await f.write(chunk)
+    
+    return image_hash.hexdigest()
+
+def get_redis(request: Request) -> Optional[aioredis.Redis]:
+    """共有Redisクライアントを取得"""
+    return request.app.state.redis
+
+def get_detector(request: Request):
+    """共有フォント検出器を取得 (未導入の環境ではNone)"""
+    return request.app.state.detector
+
+def get_detection_executor(request: Request) -> ThreadPoolExecutor:
+    """フォント検出用のスレッドプールを取得"""
+    return request.app.state.detection_executor
+
+async def get_cached_detection(redis_client: Optional[aioredis.Redis], cache_key: str) -> Optional[dict]:
+    """キャッシュ済みの検出結果を取得"""
+    try:
+        if not redis_client:
+            return None
+        cached = await redis_client.get(cache_key)
+        return orjson.loads(cached) if cached else None
+    except Exception:
+        return None
+
+async def cache_detection(redis_client: Optional[aioredis.Redis], cache_key: str, result: dict):
+    """検出結果をキャッシュに保存"""
+    try:
+        if not redis_client:
+            return
+        await redis_client.setex(cache_key, DETECTION_CACHE_TTL, orjson.dumps(result))
+    except Exception as e:
+        print(f"Warning: Failed to cache detection result: {e}")
 
 # API エンドポイント
 
@@ -187,13 +267,11 @@ async def get_current_user(token_data: dict = Depends(verify_firebase_token)):
     """現在のユーザー情報を取得"""
     firebase_uid = token_data["uid"]
     
-    user = await get_user_by_firebase_uid(firebase_uid)
+    # サブスクリプション状態も含める
+    user, subscription = await get_user_with_active_subscription(firebase_uid)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # サブスクリプション状態も含める
-    subscription = await get_active_subscription(user["id"])
-    
     return {
         "user": user,
         "subscription": {
@@ -217,10 +295,9 @@ async def check_usage_limit(
             token = authorization.split("Bearer ")[1]
             decoded_token = auth.verify_id_token(token)
             firebase_uid = decoded_token["uid"]
-            user = await get_user_by_firebase_uid(firebase_uid)
+            user, subscription = await get_user_with_active_subscription(firebase_uid)
             
             if user:
-                subscription = await get_active_subscription(user["id"])
                 return {
                     "can_use": subscription is not None,
                     "reason": "subscription_required" if not subscription else "unlimited",
@@ -252,7 +329,10 @@ async def detect_font_from_image(
     file: UploadFile = File(...),
     method: str = "ssim",
     session_id: Optional[str] = Header(None, alias="X-Session-ID"),
-    authorization: Optional[str] = Header(None)
+    authorization: Optional[str] = Header(None),
+    redis_client: Optional[aioredis.Redis] = Depends(get_redis),
+    detector = Depends(get_detector),
+    detection_executor: ThreadPoolExecutor = Depends(get_detection_executor)
 ):
     """画像からフォントを検出"""
     start_time = datetime.now()
@@ -261,14 +341,6 @@ async def detect_font_from_image(
     if file.content_type not in ["image/jpeg", "image/png", "image/webp"]:
         raise HTTPException(status_code=400, detail="Invalid file type")
     
-    # ファイルサイズ制限 (10MB)
-    file_content = await file.read()
-    if len(file_content) > 10 * 1024 * 1024:
-        raise HTTPException(status_code=400, detail="File too large")
-    
-    # 画像ハッシュ計算
-    image_hash = calculate_image_hash(file_content)
-    
     # 使用制限チェック
     user_id = None
     
@@ -278,10 +350,9 @@ async def detect_font_from_image(
             token = authorization.split("Bearer ")[1]
             decoded_token = auth.verify_id_token(token)
             firebase_uid = decoded_token["uid"]
-            user = await get_user_by_firebase_uid(firebase_uid)
+            user, subscription = await get_user_with_active_subscription(firebase_uid)
             if user:
                 user_id = user["id"]
-                subscription = await get_active_subscription(user_id)
                 if not subscription:
                     raise HTTPException(status_code=403, detail="Active subscription required")
         except Exception:
@@ -296,38 +367,56 @@ async def detect_font_from_image(
         else:
             raise HTTPException(status_code=400, detail="Session ID required")
     
+    # 検出器を読み込めなかった環境では検出できない (使用回数にも数えない)
+    if detector is None:
+        raise HTTPException(status_code=503, detail="Font detection is temporarily unavailable")
+    
     try:
-        # 一時ファイルに保存してフォント検出実行
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as temp_file:
-            temp_file.write(file_content)
-            temp_file.flush()
-            
-            # 一時的にモック結果を返す（デプロイ成功後に実装を完成させる）
-            extracted_text = ["サンプルテキスト"]
-            
-            # モックフォント検出結果
+        # 一時ファイルにストリーミング保存 (ファイルサイズ制限・画像ハッシュ計算も同時に行う)
+        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
+        temp_file.close()
+        image_hash = await save_upload_to_file(file, temp_file.name)
+        
+        # 同じ画像・手法の検出結果がキャッシュにあれば再利用
+        # (キャッシュするのは検出器の結果のみ。v1 にはモック結果が混在するため使わない)
+        cache_key = f"det:v2:{method}:{image_hash}"
+        result = await get_cached_detection(redis_client, cache_key)
+        
+        if result:
+            result["processing_time"] = (datetime.now() - start_time).total_seconds()
+        else:
+            # CPU処理でイベントループをブロックしないよう検出用のスレッドプールで実行
+            font_candidates, extracted_text = await asyncio.get_running_loop().run_in_executor(
+                detection_executor, detector.detect_font_with_text, temp_file.name, method
+            )
             candidates = [
-                {"font_name": "ヒラギノ角ゴシック", "confidence": 0.85},
-                {"font_name": "游ゴシック", "confidence": 0.72},
-                {"font_name": "Noto Sans JP", "confidence": 0.68}
+                {"font_name": font_name, "confidence": float(score)}
+                for font_name, score in font_candidates
             ]
             
-        # 処理時間計算
-        processing_time = (datetime.now() - start_time).total_seconds()
-        
-        # 結果
-        result = {
-            "candidates": candidates,
-            "text_extracted": extracted_text,
-            "processing_time": processing_time,
-            "method": method
-        }
+            # 処理時間計算
+            processing_time = (datetime.now() - start_time).total_seconds()
+            
+            # 結果
+            result = {
+                "candidates": candidates,
+                "text_extracted": extracted_text,
+                "processing_time": processing_time,
+                "method": method
+            }
+            
+            await cache_detection(redis_client, cache_key, result)
         
         # 使用ログ記録
         await log_usage(user_id, session_id, image_hash, method, result)
         
         return result
         
+    except HTTPException:
+        raise
+    except ValueError:
+        # 画像として読み込めないファイル
+        raise HTTPException(status_code=400, detail="Could not decode the uploaded image")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Font detection failed: {str(e)}")
     
@@ -353,28 +442,18 @@ async def get_detection_history(
         if not supabase:
             return {"history": []}
             
+        # results (JSONB) から必要なフィールドだけをDB側で取り出す
         result = supabase.table("usage_logs")\
-            .select("*")\
+            .select(
+                "id,created_at,method:detection_method,"
+                "candidates:results->candidates,text_extracted:results->text_extracted"
+            )\
             .eq("user_id", user["id"])\
             .order("created_at", desc=True)\
             .limit(limit)\
             .execute()
         
-        history = []
-        for log in result.data:
-            try:
-                results = json.loads(log["results"])
-                history.append({
-                    "id": log["id"],
-                    "created_at": log["created_at"],
-                    "method": log["detection_method"],
-                    "candidates": results.get("candidates", []),
-                    "text_extracted": results.get("text_extracted", [])
-                })
-            except:
-                continue
-        
-        return {"history": history}
+        return {"history": result.data}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch history: {str(e)}")
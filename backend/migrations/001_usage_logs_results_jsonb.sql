@@ -0,0 +1,4 @@
+-- usage_logs.results を JSONB に変更
+-- 検出履歴の取得時に必要なフィールドだけをDB側で取り出せるようにする
+ALTER TABLE usage_logs
+    ALTER COLUMN results TYPE jsonb USING results::jsonb;
@@ -0,0 +1,3 @@
+-- セッション使用回数のカウントとアクティブなサブスクリプション検索用インデックス
+CREATE INDEX IF NOT EXISTS usage_logs_session_id_idx ON usage_logs(session_id);
+CREATE INDEX IF NOT EXISTS subscriptions_user_id_status_idx ON subscriptions(user_id, status);
@@ -0,0 +1,3 @@
+-- Webhookで同期したサブスクリプション状態だけで /subscription/status に応答できるようにする
+ALTER TABLE subscriptions
+    ADD COLUMN IF NOT EXISTS cancel_at_period_end boolean NOT NULL DEFAULT false;
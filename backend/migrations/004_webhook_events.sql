@@ -0,0 +1,13 @@
+-- 受信したStripe Webhookイベント
+-- 受信時に保存し、バックグラウンド処理が完了したら processed_at を設定する
+-- (再起動時は processed_at が NULL のイベントを再処理する)
+CREATE TABLE IF NOT EXISTS webhook_events (
+    event_id text PRIMARY KEY,
+    event_type text NOT NULL,
+    payload jsonb NOT NULL,
+    received_at timestamptz NOT NULL DEFAULT now(),
+    processed_at timestamptz
+);
+
+CREATE INDEX IF NOT EXISTS webhook_events_unprocessed_idx
+    ON webhook_events(received_at) WHERE processed_at IS NULL;
@@ -0,0 +1,3 @@
+-- Stripe側のイベント作成時刻 (event.created, UNIX秒)
+ALTER TABLE webhook_events
+    ADD COLUMN IF NOT EXISTS event_created bigint;
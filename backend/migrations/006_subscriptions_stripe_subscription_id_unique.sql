@@ -0,0 +1,8 @@
+-- stripe_subscription_id で upsert できるよう一意制約を追加
+-- (既存の重複行がある場合は事前に削除しておくこと)
+CREATE UNIQUE INDEX IF NOT EXISTS subscriptions_stripe_subscription_id_key
+    ON subscriptions(stripe_subscription_id);
+
+-- upsert では created_at を送らず (既存行の作成時刻を上書きしないため)、新規行はDB側で設定する
+ALTER TABLE subscriptions
+    ALTER COLUMN created_at SET DEFAULT now();
@@ -0,0 +1,20 @@
+-- ユーザーと最新のサブスクリプションを1回の呼び出しで取得するRPC
+-- 戻り値: {"user": {...}, "subscription": {...} | null}  (ユーザーが存在しない場合はNULL)
+CREATE OR REPLACE FUNCTION get_user_subscription_summary(p_firebase_uid text)
+RETURNS jsonb
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT jsonb_build_object(
+        'user', to_jsonb(u),
+        'subscription', (
+            SELECT to_jsonb(s)
+            FROM subscriptions s
+            WHERE s.user_id = u.id
+            ORDER BY s.created_at DESC
+            LIMIT 1
+        )
+    )
+    FROM users u
+    WHERE u.firebase_uid = p_firebase_uid
+$$;
@@ -0,0 +1,7 @@
+-- ユーザーごとの最新サブスクリプション検索用インデックス
+-- (get_user_subscription_summary の ORDER BY created_at DESC LIMIT 1 に対応)
+-- stripe_subscription_id のインデックスは 006 で一意インデックスとして作成済み
+--
+-- CONCURRENTLY はトランザクション内では実行できないため、このファイルは単独で実行すること
+CREATE INDEX CONCURRENTLY IF NOT EXISTS subscriptions_user_id_created_at_idx
+    ON subscriptions(user_id, created_at DESC);
@@ -0,0 +1,29 @@
+-- get_user_subscription_summary のサブスクリプションを必要なカラムのみに絞る
+-- (backend/deps.py の SUBSCRIPTION_COLUMNS と揃えること)
+CREATE OR REPLACE FUNCTION get_user_subscription_summary(p_firebase_uid text)
+RETURNS jsonb
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT jsonb_build_object(
+        'user', to_jsonb(u),
+        'subscription', (
+            SELECT jsonb_build_object(
+                'stripe_subscription_id', s.stripe_subscription_id,
+                'stripe_customer_id', s.stripe_customer_id,
+                'plan_id', s.plan_id,
+                'status', s.status,
+                'current_period_start', s.current_period_start,
+                'current_period_end', s.current_period_end,
+                'cancel_at_period_end', s.cancel_at_period_end,
+                'updated_at', s.updated_at
+            )
+            FROM subscriptions s
+            WHERE s.user_id = u.id
+            ORDER BY s.created_at DESC
+            LIMIT 1
+        )
+    )
+    FROM users u
+    WHERE u.firebase_uid = p_firebase_uid
+$$;
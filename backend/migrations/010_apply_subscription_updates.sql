@@ -0,0 +1,23 @@
+-- Webhookでバッファしたサブスクリプション更新を1回の呼び出しでまとめて反映するRPC
+-- p_updates: [{"stripe_subscription_id": ..., "status": ..., ...}, ...]
+-- 指定されなかったカラムは既存の値を維持する
+CREATE OR REPLACE FUNCTION apply_subscription_updates(p_updates jsonb)
+RETURNS void
+LANGUAGE sql
+AS $$
+    UPDATE subscriptions s
+    SET status = COALESCE(u.status, s.status),
+        current_period_start = COALESCE(u.current_period_start, s.current_period_start),
+        current_period_end = COALESCE(u.current_period_end, s.current_period_end),
+        cancel_at_period_end = COALESCE(u.cancel_at_period_end, s.cancel_at_period_end),
+        updated_at = COALESCE(u.updated_at, s.updated_at)
+    FROM jsonb_to_recordset(p_updates) AS u(
+        stripe_subscription_id text,
+        status text,
+        current_period_start timestamptz,
+        current_period_end timestamptz,
+        cancel_at_period_end boolean,
+        updated_at timestamptz
+    )
+    WHERE s.stripe_subscription_id = u.stripe_subscription_id
+$$;
@@ -0,0 +1,25 @@
+-- Webhookイベント処理のリース
+-- 複数レプリカで同じイベントを二重に処理しないよう、処理を開始したプロセスが processing_started_at を設定する
+-- (処理に失敗したままリースが切れたイベントは claim_webhook_events で再取得される)
+ALTER TABLE webhook_events
+    ADD COLUMN IF NOT EXISTS processing_started_at timestamptz;
+
+-- 未処理かつリース切れのイベントのリースを取得し、そのペイロードを返すRPC
+CREATE OR REPLACE FUNCTION claim_webhook_events(p_lease_seconds integer, p_limit integer DEFAULT 500)
+RETURNS TABLE (payload jsonb)
+LANGUAGE sql
+AS $$
+    UPDATE webhook_events w
+    SET processing_started_at = now()
+    WHERE w.event_id IN (
+        SELECT event_id
+        FROM webhook_events
+        WHERE processed_at IS NULL
+          AND (processing_started_at IS NULL
+               OR processing_started_at < now() - make_interval(secs => p_lease_seconds))
+        ORDER BY received_at
+        LIMIT p_limit
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING w.payload
+$$;
@@ -0,0 +1,19 @@
+-- 所有者チェックと解約予約 (cancel_at_period_end = true) を1回で行うRPC
+-- 所有者でない場合は行を返さない。Stripe側の解約に失敗した場合に元に戻せるよう、更新前の値を返す
+CREATE OR REPLACE FUNCTION request_subscription_cancel(p_user_id text, p_stripe_subscription_id text)
+RETURNS TABLE (previous_cancel_at_period_end boolean)
+LANGUAGE sql
+AS $$
+    UPDATE subscriptions s
+    SET cancel_at_period_end = true,
+        updated_at = now()
+    FROM (
+        SELECT stripe_subscription_id, cancel_at_period_end
+        FROM subscriptions
+        WHERE stripe_subscription_id = p_stripe_subscription_id
+          AND user_id::text = p_user_id
+        FOR UPDATE
+    ) old
+    WHERE s.stripe_subscription_id = old.stripe_subscription_id
+    RETURNING COALESCE(old.cancel_at_period_end, false)
+$$;
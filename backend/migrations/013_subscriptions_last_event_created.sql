@@ -0,0 +1,30 @@
+-- サブスクリプションに最後に反映したWebhookイベントの作成時刻 (event.created, UNIX秒)
+-- 再試行・再取得で遅れて処理された古いイベントが新しい状態を上書きしないようにする
+ALTER TABLE subscriptions
+    ADD COLUMN IF NOT EXISTS last_event_created bigint;
+
+-- apply_subscription_updates (010) を、より新しいイベントを反映済みの行は更新しないよう置き換え
+CREATE OR REPLACE FUNCTION apply_subscription_updates(p_updates jsonb)
+RETURNS void
+LANGUAGE sql
+AS $$
+    UPDATE subscriptions s
+    SET status = COALESCE(u.status, s.status),
+        current_period_start = COALESCE(u.current_period_start, s.current_period_start),
+        current_period_end = COALESCE(u.current_period_end, s.current_period_end),
+        cancel_at_period_end = COALESCE(u.cancel_at_period_end, s.cancel_at_period_end),
+        updated_at = COALESCE(u.updated_at, s.updated_at),
+        last_event_created = GREATEST(s.last_event_created, u.event_created)
+    FROM jsonb_to_recordset(p_updates) AS u(
+        stripe_subscription_id text,
+        status text,
+        current_period_start timestamptz,
+        current_period_end timestamptz,
+        cancel_at_period_end boolean,
+        updated_at timestamptz,
+        event_created bigint
+    )
+    WHERE s.stripe_subscription_id = u.stripe_subscription_id
+      AND (s.last_event_created IS NULL OR u.event_created IS NULL
+           OR u.event_created >= s.last_event_created)
+$$;
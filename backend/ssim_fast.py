@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+SSIM constants and an optional Numba-compiled SSIM kernel.
+Used by JapaneseFontDetector to score a query against stacks of font samples.
+"""
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+# SSIM parameters, matching skimage.metrics.structural_similarity defaults
+SSIM_WIN_SIZE = 7
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+# Sample covariance normalization, as skimage uses by default
+SSIM_COV_NORM = SSIM_WIN_SIZE ** 2 / (SSIM_WIN_SIZE ** 2 - 1)
+
+_PAD = (SSIM_WIN_SIZE - 1) // 2
+_NUM_PIXELS = SSIM_WIN_SIZE ** 2
+
+
+if njit is not None:
+    # Not parallel=True: detections already run concurrently on worker threads, and
+    # Numba's workqueue threading layer aborts the process on concurrent parallel calls.
+    @njit(fastmath=True, cache=True)
+    def ssim_batch_u8(query: np.ndarray, samples: np.ndarray,
+                      query_mu: np.ndarray, query_var: np.ndarray,
+                      samples_mu: np.ndarray, samples_var: np.ndarray) -> np.ndarray:
+        """
+        Mean SSIM of a uint8 query against each image of a uint8 stack.
+
+        Local means and variances are passed in precomputed, so the kernel
+        only accumulates the windowed cross term, and only over the pixels
+        that survive the border crop.
+
+        Args:
+            query: (H, W) uint8 image
+            samples: (K, H, W) uint8 stack
+            query_mu, query_var: (H, W) local statistics of query
+            samples_mu, samples_var: (K, H, W) local statistics of samples
+
+        Returns:
+            (K,) array of mean SSIM scores
+        """
+        k, h, w = samples.shape
+        scores = np.empty(k)
+
+        for i in range(k):
+            total = 0.0
+            for r in range(_PAD, h - _PAD):
+                for c in range(_PAD, w - _PAD):
+                    cross = 0.0
+                    for dr in range(-_PAD, _PAD + 1):
+                        for dc in range(-_PAD, _PAD + 1):
+                            cross += np.float64(query[r + dr, c + dc]) * \
+                                np.float64(samples[i, r + dr, c + dc])
+
+                    ux = np.float64(query_mu[r, c])
+                    uy = np.float64(samples_mu[i, r, c])
+                    vxy = SSIM_COV_NORM * (cross / _NUM_PIXELS - ux * uy)
+                    total += ((2 * ux * uy + SSIM_C1) * (2 * vxy + SSIM_C2)) / \
+                        ((ux * ux + uy * uy + SSIM_C1) *
+                         (query_var[r, c] + samples_var[i, r, c] + SSIM_C2))
+
+            scores[i] = total / ((h - 2 * _PAD) * (w - 2 * _PAD))
+
+        return scores
+else:
+    ssim_batch_u8 = None
@@ -5,18 +5,32 @@ Stripe サブスクリプション サービス
 
 import stripe
 import os
-from datetime import datetime
-from typing import Optional, Dict
-from supabase import create_client, Client
+import orjson
+import asyncio
+import random
+import uuid
+import weakref
+from datetime import datetime, timezone
+from typing import Optional, Dict, List
+from cachetools import TTLCache
+import requests
+from requests.adapters import HTTPAdapter
+from deps import supabase, BLOCKING_IO_THREADS
 
 # 設定
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
 stripe.api_key = STRIPE_SECRET_KEY
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+# api.stripe.com への接続をスレッド間で使い回す (呼び出しごとのTLSハンドシェイクを避ける)
+# Stripe SDKの既定ではスレッドごとにSessionを作るが、ここでは1つのSessionを共有するため、
+# プールをI/Oスレッド数に合わせ、空きがない場合は接続を破棄せず空くまで待つ (pool_block)
+_stripe_session = requests.Session()
+_stripe_session.mount("https://", HTTPAdapter(
+    pool_connections=1, pool_maxsize=BLOCKING_IO_THREADS, pool_block=True
+))
+stripe.default_http_client = stripe.RequestsClient(session=_stripe_session)
 
 # 商品・価格設定
 PLANS = {
@@ -29,6 +43,103 @@ PLANS = {
     }
 }
 
+# Stripeサブスクリプション状態のキャッシュ (15分)
+# Webhookで状態が変わった場合は _invalidate_subscription_cache で破棄する
+_SUB_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=900)
+# 同じサブスクリプションへの同時リクエストをStripe呼び出し1回にまとめるためのロック
+# (待機中のリクエストがいなくなったロックは自動的に破棄される)
+_SUB_CACHE_LOCKS: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+# ユーザーIDごとのStripeカスタマーID (作成後は変わらないため長めに保持)
+_CUSTOMER_ID_CACHE: TTLCache = TTLCache(maxsize=100_000, ttl=86400)
+
+# 署名検証済みWebhookイベントの処理待ちキュー (ACK後に run_webhook_worker が処理)
+webhook_event_queue: asyncio.Queue = asyncio.Queue()
+
+# Webhookイベント処理の再試行設定
+# プロセス内では指数バックオフで数回まで再試行し、それでも失敗したイベントはリース期限切れ後に
+# run_webhook_sweeper が (いずれかのレプリカで) 再取得する
+WEBHOOK_MAX_ATTEMPTS = 5
+WEBHOOK_LEASE_SECONDS = 300
+WEBHOOK_SWEEP_INTERVAL = 60
+_webhook_attempts: Dict[str, int] = {}
+
+# サブスクリプションIDごとの最新処理イベントの作成時刻
+_LAST_EVENT_CREATED: TTLCache = TTLCache(maxsize=100_000, ttl=86400)
+
+# Webhookによるサブスクリプション更新の書き込みバッファ (stripe_subscription_id -> 更新内容)
+# run_subscription_update_flusher が一定間隔でまとめてDBに反映する
+_pending_subscription_updates: Dict[str, Dict] = {}
+# バッファ中の更新ごとの元になったWebhookイベントID (その更新が反映された時点で処理済みにする)
+_pending_update_event_ids: Dict[str, List[str]] = {}
+# バッファ中の更新を持たず、次の反映時にそのまま処理済みにするWebhookイベントID
+_pending_processed_event_ids: List[str] = []
+SUBSCRIPTION_FLUSH_INTERVAL = 0.1
+SUBSCRIPTION_FLUSH_BATCH_SIZE = 500
+# DBエラー時の反映間隔の上限 (失敗するごとに間隔を倍にする)
+SUBSCRIPTION_FLUSH_MAX_BACKOFF = 30
+
+# 一時的なエラーとして再試行するStripe例外 (CardError・InvalidRequestErrorなどは再試行しない)
+_STRIPE_RETRYABLE_ERRORS = (stripe.error.RateLimitError, stripe.error.APIConnectionError)
+_STRIPE_MAX_ATTEMPTS = 3
+
+async def _stripe_call(fn, *args, **kwargs):
+    """Stripe APIをスレッドで呼び出し、レート制限・接続エラー時は指数バックオフで再試行"""
+    for attempt in range(_STRIPE_MAX_ATTEMPTS):
+        try:
+            return await asyncio.to_thread(fn, *args, **kwargs)
+        except _STRIPE_RETRYABLE_ERRORS:
+            if attempt == _STRIPE_MAX_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(min(2 ** attempt, 10) + random.uniform(0, 1))
+
+def _iso_now() -> str:
+    """現在時刻 (UTC) のISO 8601文字列"""
+    return datetime.now(timezone.utc).isoformat()
+
+def _queue_subscription_update(subscription_id: str, fields: Dict):
+    """サブスクリプション更新を書き込みバッファに追加 (同じIDへの更新は後勝ちでまとめる)"""
+    _pending_subscription_updates.setdefault(subscription_id, {}).update(fields)
+
+def _event_subscription_id(event) -> Optional[str]:
+    """イベントの順序判定に使うサブスクリプションID (請求書・Checkoutセッションは紐づくサブスクリプション)"""
+    data_object = event["data"]["object"]
+    if event["type"].startswith("customer.subscription."):
+        return getattr(data_object, "id", None)
+    subscription = getattr(data_object, "subscription", None)
+    return getattr(subscription, "id", subscription)
+
+def _is_stale_event(event) -> bool:
+    """同じサブスクリプションについてより新しいイベントを処理済みなら True (最新の作成時刻も記録する)"""
+    subscription_id = _event_subscription_id(event)
+    if not subscription_id:
+        return False
+    
+    last_created = _LAST_EVENT_CREATED.get(subscription_id)
+    # checkout.session.completed はStripeから最新状態を取得して保存するため捨てない
+    if (last_created is not None and event["created"] < last_created
+            and event["type"] != "checkout.session.completed"):
+        print(f"Webhook event {event['id']} is older than the last event for {subscription_id}, skipping")
+        return True
+    _LAST_EVENT_CREATED[subscription_id] = max(event["created"], last_created or 0)
+    return False
+
+def _queue_event_processed(event):
+    """処理済みのWebhookイベントを、対応する更新の反映後に処理済みとして記録するよう登録"""
+    subscription_id = _event_subscription_id(event)
+    if subscription_id in _pending_subscription_updates:
+        # DB側でも古いイベントによる上書きを防ぐため、元になったイベントの作成時刻を一緒に送る
+        fields = _pending_subscription_updates[subscription_id]
+        fields["event_created"] = max(fields.get("event_created", 0), event["created"])
+        _pending_update_event_ids.setdefault(subscription_id, []).append(event["id"])
+    else:
+        _pending_processed_event_ids.append(event["id"])
+
+def _invalidate_subscription_cache(subscription_id: Optional[str]):
+    """サブスクリプション状態のキャッシュを破棄"""
+    if subscription_id:
+        _SUB_CACHE.pop(subscription_id, None)
+
 class StripeService:
     """Stripe操作を管理するサービスクラス"""
     
@@ -36,9 +147,11 @@ class StripeService:
     async def create_customer(user_id: str, email: str) -> str:
         """Stripeカスタマーを作成"""
         try:
-            customer = stripe.Customer.create(
+            customer = await _stripe_call(
+                stripe.Customer.create,
                 email=email,
-                metadata={"user_id": user_id}
+                metadata={"user_id": user_id},
+                idempotency_key=str(uuid.uuid4())
             )
             return customer.id
         except stripe.error.StripeError as e:
@@ -48,13 +161,15 @@ class StripeService:
     async def create_subscription(customer_id: str, price_id: str, user_id: str) -> Dict:
         """サブスクリプションを作成"""
         try:
-            subscription = stripe.Subscription.create(
+            subscription = await _stripe_call(
+                stripe.Subscription.create,
                 customer=customer_id,
                 items=[{"price": price_id}],
                 payment_behavior="default_incomplete",
                 payment_settings={"save_default_payment_method": "on_subscription"},
                 expand=["latest_invoice.payment_intent"],
-                metadata={"user_id": user_id}
+                metadata={"user_id": user_id},
+                idempotency_key=str(uuid.uuid4())
             )
             
             # データベースに保存
@@ -78,7 +193,8 @@ class StripeService:
             
             plan = PLANS[plan_id]
             
-            session = stripe.checkout.Session.create(
+            session = await _stripe_call(
+                stripe.checkout.Session.create,
                 payment_method_types=["card"],
                 line_items=[{
                     "price": plan["price_id"],
@@ -87,7 +203,8 @@ class StripeService:
                 mode="subscription",
                 success_url=success_url,
                 cancel_url=cancel_url,
-                metadata={"user_id": user_id, "plan_id": plan_id}
+                metadata={"user_id": user_id, "plan_id": plan_id},
+                idempotency_key=str(uuid.uuid4())
             )
             
             return session.url
@@ -99,17 +216,14 @@ class StripeService:
     async def cancel_subscription(subscription_id: str) -> bool:
         """サブスクリプションをキャンセル"""
         try:
-            subscription = stripe.Subscription.modify(
+            subscription = await _stripe_call(
+                stripe.Subscription.modify,
                 subscription_id,
                 cancel_at_period_end=True
             )
+            _invalidate_subscription_cache(subscription_id)
             
-            # データベース更新
-            supabase.table("subscriptions")\
-                .update({"status": "canceled", "updated_at": datetime.now().isoformat()})\
-                .eq("stripe_subscription_id", subscription_id)\
-                .execute()
-            
+            # データベースの状態は customer.subscription.updated / deleted Webhookで反映
             return True
             
         except stripe.error.StripeError as e:
@@ -117,24 +231,43 @@ class StripeService:
     
     @staticmethod
     async def get_subscription_status(subscription_id: str) -> Optional[Dict]:
-        """Stripeからサブスクリプション状態を取得"""
-        try:
-            subscription = stripe.Subscription.retrieve(subscription_id)
-            return {
+        """Stripeからサブスクリプション状態を取得 (キャッシュあり)"""
+        cached = _SUB_CACHE.get(subscription_id)
+        if cached is not None:
+            return dict(cached)
+        
+        lock = _SUB_CACHE_LOCKS.get(subscription_id)
+        if lock is None:
+            lock = _SUB_CACHE_LOCKS[subscription_id] = asyncio.Lock()
+        
+        async with lock:
+            # ロック待ちの間に他のリクエストが取得済みならそれを使う
+            cached = _SUB_CACHE.get(subscription_id)
+            if cached is not None:
+                return dict(cached)
+            
+            try:
+                # stripe SDKは同期APIのため、イベントループを止めないようスレッドで実行
+                subscription = await _stripe_call(stripe.Subscription.retrieve, subscription_id)
+            except stripe.error.StripeError:
+                return None
+            
+            status = {
                 "id": subscription.id,
                 "status": subscription.status,
-                "current_period_start": datetime.fromtimestamp(subscription.current_period_start),
-                "current_period_end": datetime.fromtimestamp(subscription.current_period_end),
+                "current_period_start": datetime.fromtimestamp(subscription.current_period_start, tz=timezone.utc),
+                "current_period_end": datetime.fromtimestamp(subscription.current_period_end, tz=timezone.utc),
                 "cancel_at_period_end": subscription.cancel_at_period_end
             }
-        except stripe.error.StripeError:
-            return None
+            _SUB_CACHE[subscription_id] = status
+            return dict(status)
     
     @staticmethod
     async def create_customer_portal_session(customer_id: str, return_url: str) -> str:
         """Stripe Customer Portalセッションを作成"""
         try:
-            session = stripe.billing_portal.Session.create(
+            session = await _stripe_call(
+                stripe.billing_portal.Session.create,
                 customer=customer_id,
                 return_url=return_url,
             )
@@ -145,57 +278,235 @@ class StripeService:
     @staticmethod
     async def get_or_create_customer(user_id: str, email: str) -> str:
         """既存カスタマーを取得または新規作成"""
+        customer_id = _CUSTOMER_ID_CACHE.get(user_id)
+        if customer_id:
+            return customer_id
+        
         try:
             # データベースからカスタマーIDを取得
-            result = supabase.table("subscriptions")\
-                .select("stripe_customer_id")\
-                .eq("user_id", user_id)\
-                .limit(1)\
-                .execute()
+            result = await asyncio.to_thread(
+                supabase.table("subscriptions")
+                    .select("stripe_customer_id")
+                    .eq("user_id", user_id)
+                    .limit(1)
+                    .execute
+            )
             
             if result.data and result.data[0]["stripe_customer_id"]:
-                return result.data[0]["stripe_customer_id"]
-            
-            # カスタマーが存在しない場合は新規作成
-            customer_id = await StripeService.create_customer(user_id, email)
-            return customer_id
+                customer_id = result.data[0]["stripe_customer_id"]
+                # DBに保存済みのIDのみキャッシュする
+                # (新規作成したIDはCheckoutが別のカスタマーを作ることがあり、DBと食い違うため)
+                _CUSTOMER_ID_CACHE[user_id] = customer_id
+                return customer_id
             
         except Exception as e:
-            # 新規作成にフォールバック
-            return await StripeService.create_customer(user_id, email)
+            print(f"Warning: Failed to look up Stripe customer for {user_id}: {str(e)}")
+        
+        # カスタマーが存在しない (または取得できない) 場合は新規作成
+        return await StripeService.create_customer(user_id, email)
     
     @staticmethod
-    async def handle_webhook_event(event_data: Dict, signature: str) -> bool:
-        """Stripe Webhookイベントを処理"""
+    async def handle_webhook_event(payload: bytes, signature: str) -> bool:
+        """Stripe Webhookイベントを検証し、処理キューに登録"""
         try:
             # Webhook署名検証
             event = stripe.Webhook.construct_event(
-                event_data, signature, STRIPE_WEBHOOK_SECRET
+                payload, signature, STRIPE_WEBHOOK_SECRET
+            )
+        except Exception as e:
+            print(f"Webhook error: {str(e)}")
+            return False
+        
+        # 処理前に再起動しても再処理できるよう受信内容を保存
+        # (同じevent_idは挿入されないため、Stripeの再送は空の結果で判別できる)
+        try:
+            now_iso = _iso_now()
+            result = await asyncio.to_thread(
+                supabase.table("webhook_events").upsert({
+                    "event_id": event["id"],
+                    "event_type": event["type"],
+                    "event_created": event["created"],
+                    "payload": orjson.loads(payload),
+                    "received_at": now_iso,
+                    # 受信したプロセスが処理するため、他のレプリカが再取得しないようリースを取得
+                    "processing_started_at": now_iso
+                }, on_conflict="event_id", ignore_duplicates=True).execute
             )
             
-            event_type = event["type"]
-            data_object = event["data"]["object"]
-            
-            if event_type == "checkout.session.completed":
-                await StripeService._handle_checkout_completed(data_object)
-            
-            elif event_type == "invoice.payment_succeeded":
-                await StripeService._handle_payment_succeeded(data_object)
-            
-            elif event_type == "invoice.payment_failed":
-                await StripeService._handle_payment_failed(data_object)
-            
-            elif event_type == "customer.subscription.updated":
-                await StripeService._handle_subscription_updated(data_object)
-            
-            elif event_type == "customer.subscription.deleted":
-                await StripeService._handle_subscription_deleted(data_object)
-            
+            if not result.data:
+                print(f"Webhook event {event['id']} already received, skipping")
+                return True
+        except Exception as e:
+            # 保存できないまま受け付けると再起動時に失われるため、非2xxを返してStripeに再送させる
+            print(f"Failed to record webhook event {event['id']}: {str(e)}")
+            return False
+        
+        if _is_stale_event(event):
+            await StripeService._mark_webhook_event_processed(event["id"])
             return True
-            
+        
+        webhook_event_queue.put_nowait(event)
+        return True
+    
+    @staticmethod
+    async def run_webhook_worker():
+        """キューのWebhookイベントを順に処理 (アプリ起動時にバックグラウンドタスクとして実行)"""
+        while True:
+            event = await webhook_event_queue.get()
+            event_id = event["id"]
+            try:
+                # 再試行・再取得されたイベントも、より新しいイベントの後なら適用しない
+                if _is_stale_event(event):
+                    _webhook_attempts.pop(event_id, None)
+                    _pending_processed_event_ids.append(event_id)
+                    continue
+                
+                await StripeService._process_webhook_event(event)
+                _webhook_attempts.pop(event_id, None)
+                # DB更新はバッファ経由のため、反映後に flush_subscription_updates で処理済みにする
+                _queue_event_processed(event)
+            except Exception as e:
+                attempts = _webhook_attempts.get(event_id, 0) + 1
+                if attempts < WEBHOOK_MAX_ATTEMPTS:
+                    # 一時的なエラーに備えてバックオフ後にキューへ戻す
+                    _webhook_attempts[event_id] = attempts
+                    delay = 2 ** (attempts - 1)
+                    print(f"Webhook processing error ({event_id}), retrying in {delay}s: {str(e)}")
+                    asyncio.get_running_loop().call_later(delay, webhook_event_queue.put_nowait, event)
+                else:
+                    # processed_at は未設定のままなので、リース期限切れ後に run_webhook_sweeper が再取得する
+                    _webhook_attempts.pop(event_id, None)
+                    print(f"Webhook processing error ({event_id}), giving up for now: {str(e)}")
+            finally:
+                webhook_event_queue.task_done()
+    
+    @staticmethod
+    async def run_webhook_sweeper():
+        """未処理のまま残ったWebhookイベントを定期的に再取得 (アプリ起動時にバックグラウンドタスクとして実行)"""
+        while True:
+            await StripeService._requeue_pending_webhook_events()
+            await asyncio.sleep(WEBHOOK_SWEEP_INTERVAL)
+    
+    @staticmethod
+    async def run_subscription_update_flusher():
+        """書き込みバッファを一定間隔でDBに反映 (アプリ起動時にバックグラウンドタスクとして実行)"""
+        failures = 0
+        while True:
+            await asyncio.sleep(min(SUBSCRIPTION_FLUSH_INTERVAL * 2 ** failures, SUBSCRIPTION_FLUSH_MAX_BACKOFF))
+            if await StripeService.flush_subscription_updates():
+                failures = 0
+            else:
+                failures = min(failures + 1, 10)
+    
+    @staticmethod
+    async def flush_subscription_updates() -> bool:
+        """バッファ済みのサブスクリプション更新を一括で反映し、対応するWebhookイベントを処理済みにする"""
+        if not _pending_subscription_updates and not _pending_processed_event_ids:
+            return True
+        
+        batch = {}
+        batch_event_ids = {}
+        for subscription_id in list(_pending_subscription_updates)[:SUBSCRIPTION_FLUSH_BATCH_SIZE]:
+            batch[subscription_id] = _pending_subscription_updates.pop(subscription_id)
+            batch_event_ids[subscription_id] = _pending_update_event_ids.pop(subscription_id, [])
+        # このバッチの更新の元になったイベントと、更新を持たないイベントを反映後に処理済みにする
+        other_event_ids = _pending_processed_event_ids[:SUBSCRIPTION_FLUSH_BATCH_SIZE]
+        del _pending_processed_event_ids[:len(other_event_ids)]
+        event_ids = other_event_ids + [
+            event_id for ids in batch_event_ids.values() for event_id in ids
+        ]
+        
+        try:
+            if batch:
+                await asyncio.to_thread(
+                    supabase.rpc("apply_subscription_updates", {
+                        "p_updates": [
+                            {"stripe_subscription_id": subscription_id, **fields}
+                            for subscription_id, fields in batch.items()
+                        ]
+                    }).execute
+                )
         except Exception as e:
-            print(f"Webhook error: {str(e)}")
+            print(f"Warning: Failed to flush subscription updates: {str(e)}")
+            # 失敗した更新はバッファに戻す (その間に入った新しい更新を優先)
+            for subscription_id, fields in batch.items():
+                _pending_subscription_updates[subscription_id] = {
+                    **fields, **_pending_subscription_updates.get(subscription_id, {})
+                }
+                _pending_update_event_ids[subscription_id] = (
+                    batch_event_ids[subscription_id] + _pending_update_event_ids.get(subscription_id, [])
+                )
+            _pending_processed_event_ids[:0] = other_event_ids
             return False
+        
+        if event_ids:
+            try:
+                await asyncio.to_thread(
+                    supabase.table("webhook_events")
+                        .update({"processed_at": _iso_now()})
+                        .in_("event_id", event_ids)
+                        .execute
+                )
+            except Exception as e:
+                print(f"Warning: Failed to mark webhook events as processed: {str(e)}")
+        return True
+    
+    @staticmethod
+    async def flush_all_subscription_updates():
+        """バッファを空になるまで反映 (アプリ終了時に使用、DBエラー時は打ち切る)"""
+        while _pending_subscription_updates or _pending_processed_event_ids:
+            if not await StripeService.flush_subscription_updates():
+                break
+    
+    @staticmethod
+    async def _mark_webhook_event_processed(event_id: str):
+        """Webhookイベントを処理済みとして記録"""
+        try:
+            await asyncio.to_thread(
+                supabase.table("webhook_events")
+                    .update({"processed_at": _iso_now()})
+                    .eq("event_id", event_id)
+                    .execute
+            )
+        except Exception as e:
+            print(f"Warning: Failed to mark webhook event {event_id} as processed: {str(e)}")
+    
+    @staticmethod
+    async def _requeue_pending_webhook_events():
+        """未処理かつリース切れのWebhookイベントを取得 (リースを取り直す) してキューに戻す"""
+        try:
+            # 他のレプリカが処理中のイベントは claim_webhook_events が除外する
+            result = await asyncio.to_thread(
+                supabase.rpc("claim_webhook_events", {"p_lease_seconds": WEBHOOK_LEASE_SECONDS}).execute
+            )
+            
+            for row in sorted(result.data or [], key=lambda row: row["payload"]["created"]):
+                webhook_event_queue.put_nowait(
+                    stripe.Event.construct_from(row["payload"], stripe.api_key)
+                )
+        except Exception as e:
+            print(f"Warning: Failed to load pending webhook events: {str(e)}")
+    
+    @staticmethod
+    async def _process_webhook_event(event):
+        """検証済みWebhookイベントを種類ごとに処理"""
+        event_type = event["type"]
+        data_object = event["data"]["object"]
+        
+        if event_type == "checkout.session.completed":
+            await StripeService._handle_checkout_completed(data_object)
+        
+        elif event_type == "invoice.payment_succeeded":
+            await StripeService._handle_payment_succeeded(data_object)
+        
+        elif event_type == "invoice.payment_failed":
+            await StripeService._handle_payment_failed(data_object)
+        
+        elif event_type == "customer.subscription.updated":
+            await StripeService._handle_subscription_updated(data_object)
+        
+        elif event_type == "customer.subscription.deleted":
+            await StripeService._handle_subscription_deleted(data_object)
     
     @staticmethod
     async def _save_subscription_to_db(subscription_data: Dict, user_id: str):
@@ -206,23 +517,40 @@ class StripeService:
             "stripe_subscription_id": subscription_data.id,
             "status": subscription_data.status,
             "plan_id": "basic_monthly",  # 現在は1プランのみ
-            "current_period_start": datetime.fromtimestamp(subscription_data.current_period_start).isoformat(),
-            "current_period_end": datetime.fromtimestamp(subscription_data.current_period_end).isoformat(),
-            "created_at": datetime.now().isoformat(),
-            "updated_at": datetime.now().isoformat()
+            "current_period_start": datetime.fromtimestamp(subscription_data.current_period_start, tz=timezone.utc).isoformat(),
+            "current_period_end": datetime.fromtimestamp(subscription_data.current_period_end, tz=timezone.utc).isoformat(),
+            "cancel_at_period_end": subscription_data.cancel_at_period_end,
+            "updated_at": _iso_now()
         }
         
-        supabase.table("subscriptions").insert(subscription_record).execute()
+        # 保存するカスタマーIDが正となるため、キャッシュ済みのIDは破棄
+        _CUSTOMER_ID_CACHE.pop(user_id, None)
+        
+        # Stripeから取得した最新の状態で上書きするため、バッファ中の古い更新は破棄
+        _pending_subscription_updates.pop(subscription_data.id, None)
+        _pending_processed_event_ids.extend(_pending_update_event_ids.pop(subscription_data.id, []))
+        
+        # Webhookの再送やcreate_subscriptionとの重複でも1行にまとめる
+        # (created_at は送らず、新規行のみDBのデフォルト値で設定される)
+        await asyncio.to_thread(
+            supabase.table("subscriptions")
+                .upsert(subscription_record, on_conflict="stripe_subscription_id")
+                .execute
+        )
     
     @staticmethod
     async def _handle_checkout_completed(session):
         """Checkout完了時の処理"""
         user_id = session.metadata.get("user_id")
-        subscription_id = session.subscription
+        subscription = session.subscription
         
-        if user_id and subscription_id:
-            # Stripeから最新のサブスクリプション情報を取得
-            subscription = stripe.Subscription.retrieve(subscription_id)
+        if user_id and subscription:
+            # 展開済みでなければ、セッション取得時にサブスクリプションも展開して1回のAPI呼び出しで取得
+            if isinstance(subscription, str):
+                session = await _stripe_call(
+                    stripe.checkout.Session.retrieve, session.id, expand=["subscription"]
+                )
+                subscription = session.subscription
             await StripeService._save_subscription_to_db(subscription, user_id)
     
     @staticmethod
@@ -231,11 +559,10 @@ class StripeService:
         subscription_id = invoice.subscription
         
         if subscription_id:
+            _invalidate_subscription_cache(subscription_id)
+            
             # サブスクリプション状態を'active'に更新
-            supabase.table("subscriptions")\
-                .update({"status": "active", "updated_at": datetime.now().isoformat()})\
-                .eq("stripe_subscription_id", subscription_id)\
-                .execute()
+            _queue_subscription_update(subscription_id, {"status": "active", "updated_at": _iso_now()})
     
     @staticmethod
     async def _handle_payment_failed(invoice):
@@ -243,37 +570,33 @@ class StripeService:
         subscription_id = invoice.subscription
         
         if subscription_id:
+            _invalidate_subscription_cache(subscription_id)
+            
             # サブスクリプション状態を'past_due'に更新
-            supabase.table("subscriptions")\
-                .update({"status": "past_due", "updated_at": datetime.now().isoformat()})\
-                .eq("stripe_subscription_id", subscription_id)\
-                .execute()
+            _queue_subscription_update(subscription_id, {"status": "past_due", "updated_at": _iso_now()})
     
     @staticmethod
     async def _handle_subscription_updated(subscription):
         """サブスクリプション更新時の処理"""
         subscription_id = subscription.id
+        _invalidate_subscription_cache(subscription_id)
         
         # データベースの情報を更新
         update_data = {
             "status": subscription.status,
-            "current_period_start": datetime.fromtimestamp(subscription.current_period_start).isoformat(),
-            "current_period_end": datetime.fromtimestamp(subscription.current_period_end).isoformat(),
-            "updated_at": datetime.now().isoformat()
+            "current_period_start": datetime.fromtimestamp(subscription.current_period_start, tz=timezone.utc).isoformat(),
+            "current_period_end": datetime.fromtimestamp(subscription.current_period_end, tz=timezone.utc).isoformat(),
+            "cancel_at_period_end": subscription.cancel_at_period_end,
+            "updated_at": _iso_now()
         }
         
-        supabase.table("subscriptions")\
-            .update(update_data)\
-            .eq("stripe_subscription_id", subscription_id)\
-            .execute()
+        _queue_subscription_update(subscription_id, update_data)
     
     @staticmethod
     async def _handle_subscription_deleted(subscription):
         """サブスクリプション削除時の処理"""
         subscription_id = subscription.id
+        _invalidate_subscription_cache(subscription_id)
         
         # サブスクリプション状態を'canceled'に更新
-        supabase.table("subscriptions")\
-            .update({"status": "canceled", "updated_at": datetime.now().isoformat()})\
-            .eq("stripe_subscription_id", subscription_id)\
-            .execute()
\ No newline at end of file
+        _queue_subscription_update(subscription_id, {"status": "canceled", "updated_at": _iso_now()})
\ No newline at end of file
@@ -3,16 +3,51 @@
 サブスクリプション関連のAPIルート
 """
 
-from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
 from pydantic import BaseModel
 from typing import Optional
+from datetime import datetime, timedelta, timezone
+import asyncio
 import json
+import os
 
-from stripe_service import StripeService
-from main import verify_firebase_token, get_user_by_firebase_uid
+from stripe_service import StripeService, PLANS
+from deps import supabase, verify_firebase_token, get_user_by_firebase_uid, get_user_subscription_summary
 
 router = APIRouter(prefix="/subscription", tags=["subscription"])
 
+# Webhookで更新されてからこの期間内のDB情報はStripeに問い合わせずに使う
+SUBSCRIPTION_FRESHNESS = timedelta(minutes=5)
+DB_TRUSTED_STATUSES = {"active", "canceled", "past_due"}
+
+# 料金プランは実行中に変わらないため、レスポンスは起動時に一度だけ作成
+_PLANS_RESPONSE = {
+    "plans": [
+        {
+            "id": plan_id,
+            "name": plan_info["name"],
+            "amount": plan_info["amount"],
+            "currency": plan_info["currency"],
+            "interval": plan_info["interval"]
+        }
+        for plan_id, plan_info in PLANS.items()
+    ]
+}
+
+def _is_db_subscription_fresh(subscription: dict) -> bool:
+    """DBのサブスクリプション情報が最新とみなせるかを判定"""
+    if subscription.get("status") not in DB_TRUSTED_STATUSES:
+        return False
+    if not subscription.get("current_period_end") or not subscription.get("updated_at"):
+        return False
+    
+    try:
+        updated_at = datetime.fromisoformat(subscription["updated_at"])
+    except (TypeError, ValueError):
+        return False
+    now = datetime.now(timezone.utc) if updated_at.tzinfo else datetime.now()
+    return now - updated_at <= SUBSCRIPTION_FRESHNESS
+
 # リクエストモデル
 class CreateCheckoutRequest(BaseModel):
     plan_id: str
@@ -59,29 +94,18 @@ async def create_checkout_session(
 async def get_subscription_status(token_data: dict = Depends(verify_firebase_token)):
     """ユーザーのサブスクリプション状態を取得"""
     firebase_uid = token_data["uid"]
-    user = await get_user_by_firebase_uid(firebase_uid)
+    # ユーザーと最新のサブスクリプションを1回で取得
+    user, subscription = await get_user_subscription_summary(firebase_uid)
     
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     try:
-        from main import get_active_subscription, supabase
-        
-        # データベースからサブスクリプション情報を取得
-        result = supabase.table("subscriptions")\
-            .select("*")\
-            .eq("user_id", user["id"])\
-            .order("created_at", desc=True)\
-            .limit(1)\
-            .execute()
-        
-        if not result.data:
+        if not subscription:
             return SubscriptionStatusResponse(active=False)
         
-        subscription = result.data[0]
-        
-        # Stripeから最新状態を取得
-        if subscription["stripe_subscription_id"]:
+        # DB情報が古い場合のみStripeから最新状態を取得
+        if subscription["stripe_subscription_id"] and not _is_db_subscription_fresh(subscription):
             stripe_status = await StripeService.get_subscription_status(
                 subscription["stripe_subscription_id"]
             )
@@ -95,12 +119,13 @@ async def get_subscription_status(token_data: dict = Depends(verify_firebase_tok
                     cancel_at_period_end=stripe_status["cancel_at_period_end"]
                 )
         
-        # Stripe情報が取得できない場合はDB情報を返す
+        # DB情報が最新、またはStripe情報が取得できない場合はDB情報を返す
         return SubscriptionStatusResponse(
             active=subscription["status"] == "active",
             plan_id=subscription["plan_id"],
             status=subscription["status"],
-            current_period_end=subscription["current_period_end"]
+            current_period_end=subscription["current_period_end"],
+            cancel_at_period_end=subscription.get("cancel_at_period_end")
         )
         
     except Exception as e:
@@ -119,26 +144,40 @@ async def cancel_subscription(
         raise HTTPException(status_code=404, detail="User not found")
     
     try:
-        # ユーザーがこのサブスクリプションの所有者かチェック
-        from main import supabase
-        
-        result = supabase.table("subscriptions")\
-            .select("*")\
-            .eq("user_id", user["id"])\
-            .eq("stripe_subscription_id", request.subscription_id)\
-            .execute()
+        # 所有者チェックと解約予約の記録を1回のUPDATEで行う (該当行がなければ他人のサブスクリプション)
+        result = await asyncio.to_thread(
+            supabase.rpc("request_subscription_cancel", {
+                "p_user_id": str(user["id"]),
+                "p_stripe_subscription_id": request.subscription_id
+            }).execute
+        )
         
         if not result.data:
             raise HTTPException(status_code=403, detail="Subscription not found or unauthorized")
         
-        # キャンセル実行
-        success = await StripeService.cancel_subscription(request.subscription_id)
+        previous_cancel_at_period_end = result.data[0]["previous_cancel_at_period_end"]
+        
+        # キャンセル実行 (状態の確定はWebhookで反映)
+        try:
+            success = await StripeService.cancel_subscription(request.subscription_id)
+        except Exception:
+            success = False
         
         if success:
             return {"message": "Subscription canceled successfully"}
-        else:
-            raise HTTPException(status_code=400, detail="Failed to cancel subscription")
-            
+        
+        # Stripe側で失敗した場合は解約予約を元の値に戻す (既に予約済みだった場合はそのまま)
+        if not previous_cancel_at_period_end:
+            await asyncio.to_thread(
+                supabase.table("subscriptions")
+                    .update({"cancel_at_period_end": False, "updated_at": datetime.now(timezone.utc).isoformat()})
+                    .eq("stripe_subscription_id", request.subscription_id)
+                    .execute
+            )
+        raise HTTPException(status_code=400, detail="Failed to cancel subscription")
+        
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -176,30 +215,19 @@ async def create_customer_portal_session(
 async def get_billing_info(token_data: dict = Depends(verify_firebase_token)):
     """課金情報を取得"""
     firebase_uid = token_data["uid"]
-    user = await get_user_by_firebase_uid(firebase_uid)
+    # ユーザーと最新のサブスクリプションを1回で取得
+    user, subscription = await get_user_subscription_summary(firebase_uid)
     
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     try:
-        from main import supabase
-        
-        # サブスクリプション情報を取得
-        result = supabase.table("subscriptions")\
-            .select("*")\
-            .eq("user_id", user["id"])\
-            .order("created_at", desc=True)\
-            .limit(1)\
-            .execute()
-        
-        if not result.data:
+        if not subscription:
             return {
                 "has_subscription": False,
                 "customer_id": None
             }
         
-        subscription = result.data[0]
-        
         # Stripeから最新の課金情報を取得
         billing_info = {
             "has_subscription": True,
@@ -208,11 +236,12 @@ async def get_billing_info(token_data: dict = Depends(verify_firebase_token)):
             "status": subscription["status"],
             "plan_id": subscription["plan_id"],
             "current_period_start": subscription["current_period_start"],
-            "current_period_end": subscription["current_period_end"]
+            "current_period_end": subscription["current_period_end"],
+            "cancel_at_period_end": subscription.get("cancel_at_period_end")
         }
         
-        # Stripeから詳細情報を取得
-        if subscription["stripe_subscription_id"]:
+        # DB情報が古い場合のみStripeから詳細情報を取得
+        if subscription["stripe_subscription_id"] and not _is_db_subscription_fresh(subscription):
             stripe_status = await StripeService.get_subscription_status(
                 subscription["stripe_subscription_id"]
             )
@@ -225,25 +254,14 @@ async def get_billing_info(token_data: dict = Depends(verify_firebase_token)):
         raise HTTPException(status_code=500, detail=f"Failed to get billing info: {str(e)}")
 
 @router.get("/plans")
-async def get_available_plans():
+async def get_available_plans(response: Response):
     """利用可能な料金プランを取得"""
-    from stripe_service import PLANS
-    
-    plans = []
-    for plan_id, plan_info in PLANS.items():
-        plans.append({
-            "id": plan_id,
-            "name": plan_info["name"],
-            "amount": plan_info["amount"],
-            "currency": plan_info["currency"],
-            "interval": plan_info["interval"]
-        })
-    
-    return {"plans": plans}
+    response.headers["Cache-Control"] = "public, max-age=3600"
+    return _PLANS_RESPONSE
 
-@router.post("/webhook")
+@router.post("/webhook", status_code=202)
 async def stripe_webhook(request: Request):
-    """Stripe Webhookエンドポイント"""
+    """Stripe Webhookエンドポイント (署名検証後すぐにACKし、処理はバックグラウンドで行う)"""
     try:
         payload = await request.body()
         signature = request.headers.get("Stripe-Signature")
@@ -251,20 +269,15 @@ async def stripe_webhook(request: Request):
         if not signature:
             raise HTTPException(status_code=400, detail="Missing Stripe signature")
         
-        # Webhookイベント処理
+        # Webhookイベントを検証して処理キューに登録
         success = await StripeService.handle_webhook_event(
-            payload.decode(), signature
+            payload, signature
         )
         
         if success:
-            return {"status": "success"}
+            return {"status": "accepted"}
         else:
             raise HTTPException(status_code=400, detail="Webhook processing failed")
             
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Webhook error: {str(e)}")
-
-# メインのFastAPIアプリにルーターを追加
-# main.pyに以下を追加:
-# from subscription_routes import router as subscription_router
-# app.include_router(subscription_router)
\ No newline at end of file